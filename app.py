@@ -2,31 +2,122 @@ import requests
 import json
 import time
 import threading
+import sched
 import logging
 import os
-from airtable import Airtable
+import queue
+import tempfile
+import atexit
+import base64
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timezone
+import re
 import sys
+import functools
 
-# Set up logging
-logging.basicConfig(filename='recipe_logs.log', level=logging.INFO, format='%(asctime)s %(message)s')
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder is used without it
+    orjson = None
+
+# Set up logging: recipe threads only enqueue records, a background listener writes them to disk
+log_queue = queue.Queue(-1)
+_log_file_handler = RotatingFileHandler('recipe_logs.log', maxBytes=10_000_000, backupCount=5)
+_log_file_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+log_listener = QueueListener(log_queue, _log_file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Airtable caps pages at 100 records; staying just below avoids an extra empty offset page
+PAGE_SIZE = 95
+
+# Airtable locks out a base for 30 seconds after it returns a 429
+RATE_LIMIT_PENALTY = 30
+
+# Airtable allows 5 requests per second per base, shared by every recipe on it
+BASE_REQUESTS_PER_SECOND = 5
+
+# Each recipe persists the Last Modified time of the records it has handled next to its recipe file
+STATE_SUFFIX = '.state.json'
+
+# How far the change watermark trails the newest Last Modified seen
+WATERMARK_LAG = 60
+
+AIRTABLE_API_URL = 'https://api.airtable.com/v0'
+
+# Recipes with a notification_url are pushed changes by Airtable instead of polling for them
+RECEIVER_PORT = int(os.environ.get('RECEIVER_PORT', 8080))
+PING_PATH = '/airtable/ping/'
+
+# Airtable disables webhooks that are not refreshed within 7 days
+WEBHOOK_REFRESH_INTERVAL = 24 * 60 * 60
+
+# Records changed in a notification are fetched this many at a time with an OR(RECORD_ID()=...) formula
+RECORD_ID_BATCH = 50
+
+# Seconds to wait for Airtable or a webhook receiver before giving up on a request
+HTTP_TIMEOUT = 10
+
+# One keep-alive connection pool shared by every Airtable request and outbound webhook.
+# Idempotent requests are retried on transient 5xx errors; POSTs and 429s are left to the caller.
+_retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=_retry))
+SESSION.mount('http://', HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=_retry))
+
+# Polls, notification runs and webhook refreshes share this many worker threads
+POOL_WORKERS = 32
+
+# Webhooks detected in one poll are sent concurrently, at most this many at a time
+WEBHOOK_CONCURRENCY = 16
+_webhook_pool = ThreadPoolExecutor(max_workers=WEBHOOK_CONCURRENCY)
 
 class Automation:
     TRIGGERS = {
         "airtable_record_updated": {
             "description": "Triggered when a record is created or updated in Airtable",
+            "required_fields": (),
         },
         "find_record": {
             "description": "Find a record based on specified text in a field",
+            "required_fields": ("field_name", "text_to_find"),
         },
     }
 
     ACTIONS = {
         "send_webhook": {
             "description": "Sends a webhook to a specified URL",
+            "required_fields": ("webhook_url",),
         },
     }
-    def __init__(self, trigger=None, action=None, webhook_url=None, base_key=None, table_name=None, api_key=None, field_name=None, text_to_find=None, name=None):
+
+    # Attributes set while a recipe runs that are not saved with it
+    RUNTIME_FIELDS = ("is_running", "is_thread_running", "last_execution_epoch")
+
+    # Accepted types of every field a recipe file may contain
+    _text = (str, type(None))
+    _number = (int, float)
+    FIELD_TYPES = {
+        "trigger": str, "action": str, "webhook_url": _text, "base_key": str, "table_name": str,
+        "api_key": str, "field_name": _text, "text_to_find": _text, "name": str,
+        "poll_min": _number, "poll_max": _number, "cache_ttl": _number,
+        "notification_url": _text, "airtable_webhook_id": _text, "airtable_mac_secret": _text,
+        "airtable_cursor": int, "batch_webhook": bool, "batch_size": int, "batch_max_wait_ms": _number,
+    }
+    REQUIRED_FIELDS = ("trigger", "action", "base_key", "table_name", "api_key", "name")
+    def __init__(self, trigger=None, action=None, webhook_url=None, base_key=None, table_name=None, api_key=None, field_name=None, text_to_find=None, name=None, poll_min=5, poll_max=300, cache_ttl=0,
+                 notification_url=None, airtable_webhook_id=None, airtable_mac_secret=None, airtable_cursor=1,
+                 batch_webhook=False, batch_size=50, batch_max_wait_ms=500):
         self.trigger = trigger
         self.action = action
         self.webhook_url = webhook_url
@@ -36,31 +127,253 @@ class Automation:
         self.field_name = field_name
         self.text_to_find = text_to_find
         self.name = name
-        self.last_execution_time = None  # New attribute to store the last execution time
+        self.poll_min = poll_min  # Seconds between polls while changes keep arriving
+        self.poll_max = poll_max  # Upper bound for the backoff when polls come back empty
+        self.cache_ttl = cache_ttl  # Seconds a fetch may be reused by recipes asking Airtable the same thing; 0 streams pages instead
+        self.notification_url = notification_url  # Public URL of this app's receiver, or None to poll
+        self.airtable_webhook_id = airtable_webhook_id
+        self.airtable_mac_secret = airtable_mac_secret
+        self.airtable_cursor = airtable_cursor  # Next Airtable webhook payload to read
+        self.batch_webhook = batch_webhook  # Send matches together as {"recipe": ..., "records": [...]}
+        self.batch_size = batch_size
+        self.batch_max_wait_ms = batch_max_wait_ms  # Longest a match may wait for its batch to fill, checked between pages
+        self.last_execution_epoch = None  # New attribute to store the last execution time, in seconds since the epoch
+        # find_record text may list several comma-separated terms; any of them matches
+        text = text_to_find or ''
+        self._search_terms = [term.strip() for term in text.split(',') if term.strip()] if ',' in text else []
+        self._search_terms = self._search_terms or [text]
+        self._matcher = None
+        if len(self._search_terms) > 1:
+            self._matcher = re.compile('|'.join(map(re.escape, self._search_terms))).search
     
 
+class TokenBucket:
+    """Thread-safe token bucket that blocks callers until a token is available."""
+
+    def __init__(self, rate=BASE_REQUESTS_PER_SECOND, capacity=BASE_REQUESTS_PER_SECOND):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+_base_limiters = {}
+_base_limiters_lock = threading.Lock()
+
+def get_limiter(base_key):
+    """Return the rate limiter shared by every recipe polling the given base."""
+    with _base_limiters_lock:
+        limiter = _base_limiters.get(base_key)
+        if limiter is None:
+            limiter = _base_limiters[base_key] = TokenBucket()
+        return limiter
+
+_fetch_cache = {}  # (base_key, table_name, formula) -> (expiry on the monotonic clock, records)
+_fetch_in_flight = {}  # Same keys -> Future of the fetch currently running
+_fetch_lock = threading.Lock()
+
+def cached_fetch(key, ttl, fetch):
+    """Return fetch(), sharing the result with concurrent callers and with later ones for ttl seconds."""
+    with _fetch_lock:
+        now = time.monotonic()
+        cached = _fetch_cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        future = _fetch_in_flight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _fetch_in_flight[key] = Future()
+    if not is_owner:
+        return future.result()  # Another recipe is already fetching the same records
+
+    try:
+        records = fetch()
+    except BaseException as error:
+        with _fetch_lock:
+            del _fetch_in_flight[key]
+        future.set_exception(error)
+        raise
+    with _fetch_lock:
+        del _fetch_in_flight[key]
+        now = time.monotonic()
+        # Formulas embed a moving watermark, so drop expired keys instead of letting them pile up
+        for expired_key in [k for k, (expiry, _) in _fetch_cache.items() if expiry <= now]:
+            del _fetch_cache[expired_key]
+        if ttl > 0:
+            _fetch_cache[key] = (now + ttl, records)
+    future.set_result(records)
+    return records
+
+def dump_json(data):
+    """Serialize data to JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC)
+    return json.dumps(data).encode()
+
+def load_json(data):
+    """Parse JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 def send_webhook(url, data, recipe_name):
-    response = requests.post(url, json=data)
-    logging.info(f"Webhook sent to {url} with data: {data} for recipe {recipe_name}")
+    response = SESSION.post(url, data=dump_json(data), headers={'Content-Type': 'application/json'}, timeout=HTTP_TIMEOUT)
+    logger.info("Webhook sent to %s with data: %s for recipe %s", url, data, recipe_name)
     return response.status_code
 
+def send_webhooks(url, records, recipe_name):
+    """Send one webhook per record concurrently and wait for all of them to finish."""
+    return list(_webhook_pool.map(lambda record: send_webhook(url, {"record": record}, recipe_name), records))
+
+class WebhookBatch:
+    """Collects the records matched by a recipe and sends them the way the recipe is configured to.
+
+    Per-record recipes send every record in its own webhook, a page of matches at a time. Batching recipes
+    send a webhook whenever batch_size records are waiting or the oldest has waited batch_max_wait_ms.
+    """
+
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.records = []
+        self.first_added = None
+        self.sent = 0
+
+    def add(self, record):
+        if not self.records:
+            self.first_added = time.monotonic()
+        self.records.append(record)
+        if self.recipe.batch_webhook and len(self.records) >= self.recipe.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Send a waiting batch once its oldest record has waited batch_max_wait_ms, even before it fills."""
+        recipe = self.recipe
+        if recipe.batch_webhook and self.records and (time.monotonic() - self.first_added) * 1000 >= recipe.batch_max_wait_ms:
+            self.flush()
+
+    def flush_page(self):
+        """Called before each page is fetched, so matches are sent as the fetch goes rather than held until its end."""
+        if self.recipe.batch_webhook:
+            self.flush_if_due()
+        else:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        recipe = self.recipe
+        if recipe.batch_webhook:
+            send_webhook(recipe.webhook_url, {"recipe": recipe.name, "records": self.records}, recipe.name)
+        else:
+            send_webhooks(recipe.webhook_url, self.records, recipe.name)
+        self.sent += len(self.records)
+        self.records = []
+
+class AirtableClient:
+    """Minimal Airtable REST client that sends every request through the shared SESSION."""
+
+    def __init__(self, base_key, api_key):
+        self.base_key = base_key
+        self.headers = {'Authorization': f'Bearer {api_key}'}
+
+    def request(self, method, path, **kwargs):
+        """Call an Airtable API path such as /meta/bases/... and return the decoded JSON body.
+
+        Every call spends one token from the base's rate limiter, which all of its requests count against.
+        """
+        get_limiter(self.base_key).acquire()
+        response = SESSION.request(method, AIRTABLE_API_URL + path, headers=self.headers, timeout=HTTP_TIMEOUT, **kwargs)
+        response.raise_for_status()
+        return load_json(response.content)
+
+    def iter_pages(self, table_name, formula=None, sort=None, page_size=PAGE_SIZE):
+        """Yield the records of a table page by page; each page is only requested when it is asked for."""
+        params = {'pageSize': page_size}
+        if formula:
+            params['filterByFormula'] = formula
+        for i, (field, direction) in enumerate(sort or ()):
+            params[f'sort[{i}][field]'] = field
+            params[f'sort[{i}][direction]'] = direction
+        path = f"/{self.base_key}/{quote(table_name, safe='')}"
+        while True:
+            result = self.request('GET', path, params=params)
+            yield result['records']
+            if 'offset' not in result:
+                return
+            params['offset'] = result['offset']
+
+@functools.lru_cache(maxsize=64)
+def get_airtable_client(base_key, api_key):
+    """Return the client shared by every recipe that reads the given base with the given key."""
+    return AirtableClient(base_key, api_key)
+
 def fetch_records(base_key, table_name, api_key):
-    airtable = Airtable(base_key, table_name, api_key=api_key)
+    airtable = get_airtable_client(base_key, api_key)
     print("Fetching records from Airtable...")
-    records = airtable.get_all()
+    records = [record for page in airtable.iter_pages(table_name) for record in page]
     print(f"Fetched {len(records)} records from Airtable")
-    logging.info(f"Fetched {len(records)} records from Airtable")
+    logger.info(f"Fetched {len(records)} records from Airtable")
     return records
 
+def recipe_fields(recipe):
+    """Return the persistent fields of a recipe, leaving out runtime-only state."""
+    return {key: value for key, value in vars(recipe).items()
+            if not key.startswith('_') and key not in Automation.RUNTIME_FIELDS}
+
 def save_recipe(recipe, filename):
-    with open(filename, 'w') as file:
-        json.dump(vars(recipe), file)
-    logging.info(f"Recipe saved to {filename}")
+    write_json_atomic(recipe_fields(recipe), filename)
+    logger.info(f"Recipe saved to {filename}")
+
+def validate_recipe(recipe_data):
+    """Raise ValueError unless recipe_data is a recipe Automation can be built from."""
+    if not isinstance(recipe_data, dict):
+        raise ValueError("expected a JSON object")
+    for key, value in recipe_data.items():
+        if key not in Automation.FIELD_TYPES:
+            raise ValueError(f"unknown field '{key}'")
+        expected = Automation.FIELD_TYPES[key]
+        # bool is an int, but true and false are never meant as numbers
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            raise ValueError(f"field '{key}' has invalid value {value!r}")
+    for key in Automation.REQUIRED_FIELDS:
+        if recipe_data.get(key) is None:
+            raise ValueError(f"missing field '{key}'")
+    if recipe_data["trigger"] not in Automation.TRIGGERS:
+        raise ValueError(f"unknown trigger '{recipe_data['trigger']}'")
+    if recipe_data["action"] not in Automation.ACTIONS:
+        raise ValueError(f"unknown action '{recipe_data['action']}'")
+    for option in (Automation.TRIGGERS[recipe_data["trigger"]], Automation.ACTIONS[recipe_data["action"]]):
+        for key in option["required_fields"]:
+            if not recipe_data.get(key):
+                raise ValueError(f"missing field '{key}'")
+    recipe = Automation(**recipe_data)  # Check the values the recipe would run with, defaults included
+    if not 0 < recipe.poll_min <= recipe.poll_max:
+        raise ValueError(f"poll_min {recipe.poll_min!r} must be above 0 and at most poll_max {recipe.poll_max!r}")
+    if recipe.batch_size < 1:
+        raise ValueError(f"batch_size {recipe.batch_size!r} must be at least 1")
+    if recipe.batch_max_wait_ms < 0:
+        raise ValueError(f"batch_max_wait_ms {recipe.batch_max_wait_ms!r} must not be negative")
+    if recipe.cache_ttl < 0:
+        raise ValueError(f"cache_ttl {recipe.cache_ttl!r} must not be negative")
 
 def load_recipe(filename):
-    with open(filename, 'r') as file:
-        recipe_data = json.load(file)
-        return Automation(**recipe_data)
+    with open(filename, 'rb') as file:
+        recipe_data = load_json(file.read())
+    validate_recipe(recipe_data)
+    return Automation(**recipe_data)
 
 def create_recipe():
     print("Creating a new recipe...")
@@ -82,13 +395,17 @@ def create_recipe():
 
     field_name = None
     text_to_find = None
+    notification_url = None
     if trigger == "find_record":
         field_name = input("Step 7: Enter the field name to search in: ")
         text_to_find = input("Step 8: Enter the text to find in the field: ")
+    elif trigger == "airtable_record_updated":
+        notification_url = input("Step 7: Enter the public URL Airtable should notify (leave blank to poll): ") or None
 
     name = input("Step 9: Enter a name for this recipe: ")
 
-    return Automation(trigger, action, webhook_url, base_key, table_name, api_key, field_name, text_to_find, name)
+    return Automation(trigger, action, webhook_url, base_key, table_name, api_key, field_name, text_to_find, name,
+                      notification_url=notification_url)
 
 def select_option(options):
     numbered_options = list(enumerate(options.items(), start=1))
@@ -109,94 +426,531 @@ def select_option(options):
     return selected_option_key
 
 
-def execute_recipe(recipe):
-    recipe.is_running = True
-    logging.info(f"Monitoring Airtable for changes for recipe {recipe.name} ...")
-    airtable = Airtable(recipe.base_key, recipe.table_name, api_key=recipe.api_key)
-
-    start_time = datetime.utcnow().replace(tzinfo=None)  # Save the current time when the recipe starts
-    last_checked_time = recipe.last_execution_time or start_time  # Use last_execution_time or start_time as initial value
-    processed_records = set()
-
+def escape_formula_string(value):
+    """Escape a value for use inside a single-quoted Airtable formula string."""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def build_formula(recipe, last_checked_epoch):
+    """Build the filterByFormula expression so Airtable only returns relevant records."""
+    modified = None
+    if last_checked_epoch is not None:
+        modified = f"IS_AFTER({{Last Modified}}, '{format_time(last_checked_epoch)}')"
+    if recipe.trigger == "airtable_record_updated":
+        return modified
+    if recipe.trigger == "find_record":
+        finds = [f"FIND('{escape_formula_string(term)}', {{{recipe.field_name}}})" for term in recipe._search_terms]
+        find = finds[0] if len(finds) == 1 else f"OR({', '.join(finds)})"
+        # After the first full scan a record can only start matching by being modified
+        return find if modified is None else f"AND({find}, {modified})"
+    return None
+
+def iter_records(recipe, formula, before_page=None):
+    """Yield every record matching the formula, calling before_page before each page is fetched."""
+    pages = recipe._airtable.iter_pages(recipe.table_name, formula=formula)
     while True:
-        print("Fetching records from Airtable...")
-        records = airtable.get_all()
-        print(f"Fetched {len(records)} records from Airtable")
-
+        if before_page is not None:
+            before_page()
+        page = next(pages, None)
+        if page is None:
+            return
+        yield from page
+
+def iter_changed_records(recipe, formula, last_checked_epoch, before_page=None):
+    """Yield records modified after last_checked_epoch, newest first, stopping at the first page that reaches older ones.
+
+    before_page is called before each page is fetched, like in iter_records.
+    """
+    pages = recipe._airtable.iter_pages(recipe.table_name, formula=formula, sort=[("Last Modified", "desc")])
+    while True:
+        if before_page is not None:
+            before_page()
+        page = next(pages, None)
+        if page is None:
+            return
+        yield from page
+        oldest_time_str = page[-1]['fields'].get('Last Modified') if page else None
+        if not oldest_time_str or parse_time(oldest_time_str) <= last_checked_epoch:
+            return  # Every later page is older still
+
+def retry_after(error):
+    """Return the number of seconds to wait after a rate-limited Airtable request."""
+    try:
+        return float(error.response.headers.get('Retry-After', RATE_LIMIT_PENALTY))
+    except (TypeError, ValueError):
+        return RATE_LIMIT_PENALTY
+
+def parse_time(value):
+    """Parse an ISO 8601 timestamp into seconds since the epoch, reading naive ones as UTC."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def format_time(epoch):
+    """Format seconds since the epoch the way Airtable writes timestamps."""
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def load_state(filename):
+    """Load a recipe's persisted polling state, or an empty state if there is none yet.
+
+    Raises ValueError if the file is not a state file this app wrote.
+    """
+    try:
+        with open(filename, 'rb') as file:
+            state = load_json(file.read())
+    except FileNotFoundError:
+        return {"last_checked_time": None, "records": {}}
+    if not (isinstance(state, dict) and isinstance(state.get("last_checked_time"), (str, type(None)))
+            and isinstance(state.get("records"), dict) and all(isinstance(value, str) for value in state["records"].values())):
+        raise ValueError("malformed state file")
+    return state
+
+def write_json_atomic(data, filename):
+    """Write JSON to a temporary file and rename it over the target so readers never see a partial file."""
+    # A unique name per write, so threads saving the same file never write into each other's temporary file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(dump_json(data))
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load_records_state(recipe, state=None):
+    """Set the Last Modified of every record the recipe has handled, parsed once here rather than on every comparison."""
+    if state is None:
+        state = load_state(recipe._state_path)
+    recipe._records_state = {record_id: parse_time(value) for record_id, value in state["records"].items()}
+
+def start_recipe(recipe):
+    """Prepare the per-recipe polling state used by poll_once."""
+    recipe.is_running = True
+    logger.info(f"Monitoring Airtable for changes for recipe {recipe.name} ...")
+    recipe._airtable = get_airtable_client(recipe.base_key, recipe.api_key)
+
+    recipe._state_path = recipe.name + STATE_SUFFIX
+    state = load_state(recipe._state_path)
+    load_records_state(recipe, state)
+    # Save the time the recipe starts. Recipes that share fetches round it down to their poll interval so
+    # the ones started together on the same table send identical formulas; that also picks up edits made
+    # up to poll_min seconds before the start, so the others start exactly now.
+    start_epoch = time.time()
+    if recipe.cache_ttl > 0:
+        alignment = recipe.poll_min or 1
+        start_epoch = start_epoch // alignment * alignment
+    if state["last_checked_time"]:
+        recipe._last_checked_epoch = parse_time(state["last_checked_time"])
+    elif recipe.trigger == "airtable_record_updated":
+        recipe._last_checked_epoch = recipe.last_execution_epoch or start_epoch  # Use last_execution_epoch or start_epoch as initial value
+    else:
+        recipe._last_checked_epoch = None  # find_record starts with a scan of every matching record
+    recipe._interval = recipe.poll_min
+
+def save_state(recipe):
+    write_json_atomic({
+        "last_checked_time": None if recipe._last_checked_epoch is None else format_time(recipe._last_checked_epoch),
+        "records": {record_id: format_time(value) for record_id, value in recipe._records_state.items()},
+    }, recipe._state_path)
+
+def poll_once(recipe):
+    """Poll Airtable once for the recipe and return the number of seconds until the next poll."""
+    poll_started = time.perf_counter()
+    poll_epoch = time.time()
+    formula = build_formula(recipe, recipe._last_checked_epoch)
+
+    # Send what matched so far before every fetch, as waiting on a page also counts towards a batch's age
+    matched = WebhookBatch(recipe)
+    if recipe._last_checked_epoch is not None:
+        records = iter_changed_records(recipe, formula, recipe._last_checked_epoch, before_page=matched.flush_page)
+    else:
+        records = iter_records(recipe, formula, before_page=matched.flush_page)
+
+    last_checked_epoch = recipe._last_checked_epoch
+    records_state = recipe._records_state
+    info = logger.isEnabledFor(logging.INFO)
+    newest_epoch = last_checked_epoch or 0.0
+    state_changed = False
+    trigger = recipe.trigger
+    field_name = recipe.field_name
+    text_to_find = recipe._search_terms[0]
+    matcher = recipe._matcher
+    fetched = 0
+    skipped = 0
+    delay = None
+
+    try:
+        if recipe.cache_ttl > 0:
+            # Sharing a fetch with other recipes means holding on to it; otherwise records are handled as pages arrive
+            fetch = lambda pages=records: list(pages)
+            # The key includes the API key so a recipe is never handed records its own token could not read
+            records = cached_fetch((recipe.base_key, recipe.api_key, recipe.table_name, formula), recipe.cache_ttl, fetch)
         for record in records:
+            fetched += 1
             record_id = record['id']
-            print("Processing record:", record_id)
-            record_time_str = record['fields'].get('Last Modified')
-
-            if record_id in processed_records:
-                print("Record already processed. Skipping...")
-                continue  # Skip this record if it has already been processed
-
-            if record_time_str:
-                record_time = datetime.fromisoformat(record_time_str).replace(tzinfo=None)  # make offset-naive
-                print("Record Time:", record_time)
-
-                if recipe.trigger == "airtable_record_updated" and record_time > last_checked_time:
-                    logging.info(f"{recipe.name}: Detected updated record {record_id}")
-                    send_webhook(recipe.webhook_url, {"record": record}, recipe.name)
-
-                elif recipe.trigger == "find_record" and recipe.field_name in record['fields']:
-                    field_value = record['fields'][recipe.field_name]
-                    if isinstance(field_value, str) and recipe.text_to_find in field_value:
-                        logging.info(f"{recipe.name}: Detected record {record_id} with text '{recipe.text_to_find}' in field '{recipe.field_name}'")
-                        send_webhook(recipe.webhook_url, {"record": record}, recipe.name)
-
-            processed_records.add(record_id)
-
-        recipe.last_execution_time = last_checked_time  # Update the last execution time in the recipe
-        if not recipe.is_running:  # Check if the recipe is stopped
-            break  # If it's stopped, break out of the while loop
-        time.sleep(10)  # Wait for 10 seconds before checking again
+            fields = record['fields']
+            record_time_str = fields.get('Last Modified')
+            if not record_time_str:
+                continue  # Records without a Last Modified time can never be matched
+
+            record_epoch = parse_time(record_time_str)
+            if record_epoch > newest_epoch:
+                newest_epoch = record_epoch
+
+            previous_epoch = records_state.get(record_id)
+            if previous_epoch is not None and record_epoch <= previous_epoch:
+                skipped += 1
+                continue  # Skip this record if this version of it has already been processed
+
+            if trigger == "airtable_record_updated":
+                if record_epoch > last_checked_epoch:
+                    if info:
+                        logger.info("%s: Detected updated record %s", recipe.name, record_id)
+                    matched.add(record)
+
+            elif trigger == "find_record":
+                field_value = fields.get(field_name)
+                if isinstance(field_value, str) and (matcher(field_value) if matcher else text_to_find in field_value):
+                    if info:
+                        logger.info("%s: Detected record %s with text '%s' in field '%s'",
+                                    recipe.name, record_id, recipe.text_to_find, field_name)
+                    matched.add(record)
+
+            records_state[record_id] = record_epoch
+            state_changed = True
+    except requests.HTTPError as error:
+        if error.response is None or error.response.status_code != 429:
+            raise
+        delay = retry_after(error)
+        logger.info(f"{recipe.name}: Rate limited by Airtable, retrying in {delay} seconds")
+
+    matched_count = matched.sent + len(matched.records)
+    matched.flush()
+    logger.debug("poll name=%s fetched=%d matched=%d skipped=%d dt=%.2fms",
+                 recipe.name, fetched, matched_count, skipped, (time.perf_counter() - poll_started) * 1000)
+
+    if delay is None:
+        # Advance the watermark, trailing the newest change to tolerate records that show up late.
+        # Records at or before it are excluded by the formula, so their state can be dropped.
+        # A fetch cut short by a 429 may have missed older changes, so it leaves the watermark alone.
+        if last_checked_epoch is None:
+            watermark = poll_epoch - WATERMARK_LAG  # The first full find_record scan covered everything until now
+        else:
+            watermark = max(last_checked_epoch, newest_epoch - WATERMARK_LAG)
+        if last_checked_epoch is None or watermark > last_checked_epoch:
+            recipe._records_state = {record_id: record_epoch for record_id, record_epoch in records_state.items()
+                                     if record_epoch > watermark}
+            recipe._last_checked_epoch = watermark
+            state_changed = True
+    if state_changed:
+        save_state(recipe)
+
+    recipe.last_execution_epoch = recipe._last_checked_epoch  # Update the last execution time in the recipe
+    if delay is not None:
+        return delay  # Pick up the rest of the records once Airtable lets us back in
+    # Poll quickly while records keep changing, back off while the table is quiet
+    recipe._interval = recipe.poll_min if matched.sent else min(recipe._interval * 2, recipe.poll_max)
+    return recipe._interval
+
+def resolve_table_id(recipe):
+    """Return the tbl... id of the recipe's table, which Airtable webhook payloads are keyed by."""
+    if recipe.table_name.startswith('tbl'):
+        return recipe.table_name
+    tables = recipe._airtable.request('GET', f"/meta/bases/{recipe.base_key}/tables")['tables']
+    for table in tables:
+        if table['name'] == recipe.table_name:
+            return table['id']
+    raise ValueError(f"Table {recipe.table_name} not found in base {recipe.base_key}")
+
+def register_airtable_webhook(recipe):
+    """Ask Airtable to notify this app's receiver about records added to or updated in the recipe's table."""
+    spec = {
+        "notificationUrl": recipe.notification_url.rstrip('/') + PING_PATH + quote(recipe.name),
+        "specification": {
+            "options": {
+                "filters": {
+                    "dataTypes": ["tableData"],
+                    "changeTypes": ["add", "update"],
+                    "recordChangeScope": recipe._table_id,
+                },
+            },
+        },
+    }
+    result = recipe._airtable.request('POST', f"/bases/{recipe.base_key}/webhooks", json=spec)
+    recipe.airtable_webhook_id = result['id']
+    recipe.airtable_mac_secret = result['macSecretBase64']
+    recipe.airtable_cursor = 1
+    save_recipe(recipe, recipe.name + '.json')
+    logger.info(f"{recipe.name}: Registered Airtable webhook {recipe.airtable_webhook_id}")
+
+def refresh_airtable_webhook(recipe):
+    """Extend the life of the recipe's Airtable webhook, registering a new one if it is gone."""
+    path = f"/bases/{recipe.base_key}/webhooks/{recipe.airtable_webhook_id}/refresh"
+    try:
+        recipe._airtable.request('POST', path)
+    except requests.HTTPError as error:
+        if error.response is None or error.response.status_code != 404:
+            raise
+        logger.info(f"{recipe.name}: Airtable webhook {recipe.airtable_webhook_id} no longer exists, registering a new one")
+        register_airtable_webhook(recipe)
+
+def verify_notification(recipe, body, mac_header):
+    """Check the X-Airtable-Content-MAC header of a notification against the webhook's secret."""
+    if not mac_header or not recipe.airtable_mac_secret:
+        return False
+    secret = base64.b64decode(recipe.airtable_mac_secret)
+    expected = 'hmac-sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, mac_header)
+
+def process_notifications(recipe):
+    """Read the pending Airtable webhook payloads of a recipe and send a webhook for every changed record.
+
+    Callers hold recipe._notification_lock, so only one run per recipe reads the cursor at a time.
+    Returns None once the payloads are handled, or the seconds to wait when Airtable rate-limited the
+    run. The cursor only moves on after every webhook went out, so a failed run is read again next time.
+    """
+    changed_ids = {}
+    cursor = recipe.airtable_cursor
+    path = f"/bases/{recipe.base_key}/webhooks/{recipe.airtable_webhook_id}/payloads"
+    try:
+        while True:
+            result = recipe._airtable.request('GET', path, params={'cursor': cursor})
+            for payload in result['payloads']:
+                table = payload.get('changedTablesById', {}).get(recipe._table_id, {})
+                changed_ids.update(dict.fromkeys(table.get('createdRecordsById', {})))
+                changed_ids.update(dict.fromkeys(table.get('changedRecordsById', {})))
+            cursor = result['cursor']
+            if not result.get('mightHaveMore'):
+                break
+
+        # Payloads carry field ids, so fetch the records to send them in the same shape as polling does
+        record_ids = list(changed_ids)
+        matched = WebhookBatch(recipe)
+        for i in range(0, len(record_ids), RECORD_ID_BATCH):
+            batch = record_ids[i:i + RECORD_ID_BATCH]
+            formula = "OR(" + ", ".join(f"RECORD_ID() = '{record_id}'" for record_id in batch) + ")"
+            for record in iter_records(recipe, formula, before_page=matched.flush_page):
+                logger.info("%s: Detected updated record %s", recipe.name, record['id'])
+                matched.add(record)
+        matched.flush()
+    except requests.HTTPError as error:
+        if error.response is None or error.response.status_code != 429:
+            raise
+        delay = retry_after(error)
+        logger.info(f"{recipe.name}: Rate limited by Airtable, reading notifications again in {delay} seconds")
+        return delay
+
+    if cursor != recipe.airtable_cursor:
+        recipe.airtable_cursor = cursor
+        save_recipe(recipe, recipe.name + '.json')  # Persist the cursor
+    return None
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    """Receives Airtable webhook notification pings at PING_PATH<recipe name>."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        recipe = None
+        if self.path.startswith(PING_PATH):
+            recipe = self.server.manager.push_recipes.get(unquote(self.path[len(PING_PATH):]))
+        if recipe is None:
+            self.send_response(404)
+            self.end_headers()
+        elif not verify_notification(recipe, body, self.headers.get('X-Airtable-Content-MAC')):
+            self.send_response(401)
+            self.end_headers()
+        else:
+            # Answer right away; the payloads are read on the pool
+            self.send_response(200)
+            self.end_headers()
+            self.server.manager.notify(recipe)
 
-    recipe.is_running = False  # Ensure the recipe is marked as stopped after the loop ends
+    def log_message(self, format, *args):
+        logger.info("Receiver: " + format % args)
 
 class RecipeManager:
     def __init__(self):
         self.recipes = []
-        self.threads = []
+        self._pool = None
+        self._wakeup = threading.Event()
+        self._sched = sched.scheduler(time.monotonic, self._wait)
+        self._loaded = {}  # Recipe file name -> (st_mtime_ns, recipe) as of the last load
+        self._receiver = None
+        self.push_recipes = {}  # Recipe name -> recipe, for recipes Airtable notifies of changes
         self.load_all_recipes()
 
     def add_recipe(self, recipe):
         recipe.is_running = False  # Set is_running to False by default
         recipe.is_thread_running = False  # Set is_thread_running to False by default
         self.recipes.append(recipe)
-        thread = threading.Thread(target=execute_recipe, args=(recipe,))
-        self.threads.append(thread)
+
+    def _wait(self, timeout):
+        # Sleep until the next scheduled poll, waking early when a new one is entered
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def _run_scheduler(self):
+        while True:
+            self._sched.run()
+            self._wait(None)  # Nothing scheduled while every recipe is mid-poll
+
+    def _schedule(self, delay, recipe, job=None):
+        self._sched.enter(delay, 1, self._submit, (job or self._poll, recipe))
+        self._wakeup.set()
+
+    def _submit(self, job, recipe):
+        try:
+            self._pool.submit(job, recipe)
+        except RuntimeError:  # The pool has been shut down because the interpreter is exiting
+            recipe.is_running = False
+            recipe.is_thread_running = False
+
+    def _poll(self, recipe):
+        try:
+            delay = poll_once(recipe)
+        except requests.RequestException as error:
+            # Timeouts, dropped connections and 5xx responses pass, so back off and poll again.
+            # The failed poll may have marked records handled before sending them, so reload the saved state.
+            delay = recipe.poll_max
+            logger.info(f"{recipe.name}: Poll failed, retrying in {delay} seconds: {error}")
+            try:
+                load_records_state(recipe)
+            except (OSError, ValueError):
+                logger.exception(f"{recipe.name}: Recipe {recipe.webhook_url} stopped, its state file could not be read")
+                recipe.is_running = False
+                recipe.is_thread_running = False
+                return
+        except Exception:
+            logger.exception(f"{recipe.name}: Recipe {recipe.webhook_url} stopped after an error")
+            recipe.is_running = False
+            recipe.is_thread_running = False
+            return
+        if recipe.is_running:
+            self._schedule(delay, recipe)
+        else:
+            recipe.is_thread_running = False
+
+    def notify(self, recipe):
+        """Process the pending Airtable payloads of a push recipe on the pool."""
+        self._submit(self._process_notifications, recipe)
+
+    def _process_notifications(self, recipe):
+        # Pings that arrive while a run is in progress only flag more work for that run,
+        # so they never park a worker on the lock
+        recipe._notification_pending = True
+        while recipe._notification_pending:
+            if not recipe._notification_lock.acquire(blocking=False):
+                return
+            try:
+                while recipe._notification_pending:
+                    recipe._notification_pending = False
+                    delay = process_notifications(recipe)
+                    if delay is not None:
+                        self._schedule(delay, recipe, self._process_notifications)
+                        return
+            except Exception:
+                logger.exception(f"{recipe.name}: Failed to process Airtable notifications")
+                return
+            finally:
+                recipe._notification_lock.release()
+
+    def _refresh(self, recipe):
+        # Re-registering replaces the webhook id and cursor, so no notification run may be reading them meanwhile
+        with recipe._notification_lock:
+            try:
+                refresh_airtable_webhook(recipe)
+            except Exception:
+                logger.exception(f"{recipe.name}: Failed to refresh Airtable webhook {recipe.airtable_webhook_id}")
+        if recipe._notification_pending:
+            self.notify(recipe)  # Pings that arrived during the refresh found the lock taken
+        if recipe.is_running:
+            self._schedule(WEBHOOK_REFRESH_INTERVAL, recipe, self._refresh)
+
+    def _start_receiver(self):
+        if self._receiver is None:
+            self._receiver = ThreadingHTTPServer(('', RECEIVER_PORT), NotificationHandler)
+            self._receiver.manager = self
+            threading.Thread(target=self._receiver.serve_forever, daemon=True).start()
+            logger.info(f"Listening for Airtable notifications on port {RECEIVER_PORT}")
+
+    def _start_push(self, recipe):
+        """Switch a recipe to Airtable notifications, returning False if it has to keep polling."""
+        recipe._notification_lock = threading.Lock()
+        recipe._notification_pending = False
+        try:
+            # Bind the port first, so a busy port never leaves Airtable notifying a URL nobody serves
+            self._start_receiver()
+            recipe._table_id = resolve_table_id(recipe)
+            if recipe.airtable_webhook_id:
+                refresh_airtable_webhook(recipe)
+            else:
+                register_airtable_webhook(recipe)
+        except Exception:
+            logger.exception(f"{recipe.name}: Could not set up Airtable notifications, falling back to polling")
+            return False
+        self.push_recipes[recipe.name] = recipe
+        self.notify(recipe)  # Catch up on changes made while the recipe was not running
+        self._schedule(WEBHOOK_REFRESH_INTERVAL, recipe, self._refresh)
+        return True
 
     def start_all(self):
         if all(recipe.is_running for recipe in self.recipes):
-            logging.info("All recipes are already running")
+            logger.info("All recipes are already running")
         else:
-            for thread, recipe in zip(self.threads, self.recipes):
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=POOL_WORKERS)  # Threads are only started as work arrives
+                threading.Thread(target=self._run_scheduler, daemon=True).start()
+            for recipe in self.recipes:
                 if recipe.is_running:
-                    logging.info(f"{recipe.name}: Recipe {recipe.webhook_url} is already running")
+                    logger.info(f"{recipe.name}: Recipe {recipe.webhook_url} is already running")
                 else:
-                    thread.start()
-                    recipe.is_running = True
-                    recipe.is_thread_running = True  # Mark the thread as running
-                    logging.info(f"{recipe.name}: Recipe {recipe.webhook_url} started")
+                    try:
+                        start_recipe(recipe)
+                    except (OSError, ValueError) as error:
+                        logger.info(f"{recipe.name}: Skipping recipe, its state file {recipe.name + STATE_SUFFIX} could not be read: {error}")
+                        recipe.is_running = False
+                        continue
+                    recipe.is_thread_running = True  # Mark the recipe as scheduled
+                    pushed = (recipe.notification_url and recipe.trigger == "airtable_record_updated"
+                              and self._start_push(recipe))
+                    if not pushed:
+                        self._schedule(0, recipe)
+                    logger.info(f"{recipe.name}: Recipe {recipe.webhook_url} started")
 
 
     def log_status(self):
         for recipe in self.recipes:
             status = "running" if recipe.is_thread_running else "stopped"  # Use is_thread_running instead of is_running
             print(f"Recipe {recipe.name}: {recipe.webhook_url} is {status}")
-            logging.info(f"Recipe {recipe.name}: {recipe.webhook_url} is {status}")
+            logger.info(f"Recipe {recipe.name}: {recipe.webhook_url} is {status}")
 
 
 
 
     def load_all_recipes(self):
-        for filename in os.listdir():
-            if filename.endswith('.json'):
-                recipe = load_recipe(filename)
+        with os.scandir('.') as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json') or entry.name.endswith(STATE_SUFFIX) or not entry.is_file():
+                    continue
+                mtime = entry.stat().st_mtime_ns
+                loaded = self._loaded.get(entry.name)
+                if loaded is not None:
+                    loaded_mtime, loaded_recipe = loaded
+                    if loaded_mtime == mtime:
+                        continue  # Unchanged since it was last loaded
+                    if loaded_recipe.is_running:
+                        logger.info(f"{loaded_recipe.name}: Recipe file changed while running, keeping the loaded version")
+                        continue
+                try:
+                    recipe = load_recipe(entry.path)
+                except (OSError, ValueError) as error:
+                    logger.info(f"Skipping recipe file {entry.name}: {error}")
+                    continue
+                if loaded is not None:
+                    self.recipes.remove(loaded[1])
+                self._loaded[entry.name] = (mtime, recipe)
                 self.add_recipe(recipe)
-        logging.info(f"Loaded {len(self.recipes)} recipes")
+        logger.info(f"Loaded {len(self.recipes)} recipes")
 
     def print_logs(self):
         with open('recipe_logs.log', 'r') as file:
@@ -220,12 +974,12 @@ def main():
             user_recipe = create_recipe()
             filename = user_recipe.name + ".json"
             save_recipe(user_recipe, filename)
-            logging.info(f"Recipe saved as {filename}")
+            logger.info(f"Recipe saved as {filename}")
             manager.add_recipe(user_recipe)
             print(f"Recipe '{user_recipe.name}' created.")
         elif action == 'start':
             manager.start_all()
-            logging.info("All recipes started")
+            logger.info("All recipes started")
         elif action == 'status':
             manager.log_status()
         elif action == 'logs':